@@ -1,15 +1,53 @@
+import os
+import socket
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from flask_bcrypt import Bcrypt
 from flask_login import LoginManager
+from hub.storage import BACKENDS
 
 app = Flask(__name__)
 app.config["SECRET_KEY"] = "b0df6dd2bf64320f14ee10c1774a52a9"
-app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///data.db"
+app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get(
+    "MANEVO_DATABASE_URI", "sqlite:///data.db"
+)
+# Instances sharing one database must also share these stores. Create the
+# schema once with `flask --app hub init-db` before starting them.
+app.config["GCODE_BACKEND"] = os.environ.get("MANEVO_GCODE_BACKEND", "local")
+app.config["GCODE_STORE"] = os.environ.get(
+    "MANEVO_GCODE_STORE", os.path.join(app.root_path, "static", "gcode_files")
+)
+app.config["AVATAR_DIR"] = os.environ.get(
+    "MANEVO_AVATAR_DIR", os.path.join(app.root_path, "static", "profile_pics")
+)
+app.config["INSTANCE_ID"] = os.environ.get(
+    "MANEVO_INSTANCE_ID", f"{socket.gethostname()}-{os.getpid()}"
+)
 db = SQLAlchemy(app)
 bcrypt = Bcrypt(app)
 login_manager = LoginManager(app)
 login_manager.login_view = "login"
 login_manager.login_message_category = "info"
+gcode_store = BACKENDS[app.config["GCODE_BACKEND"]](app.config["GCODE_STORE"])
 
-from hub import routes
\ No newline at end of file
+from hub import routes
+
+with app.app_context():
+    if db.engine.dialect.name == "sqlite":
+        # WAL lets instances on the same host read while another one writes
+        @db.event.listens_for(db.engine, "connect")
+        def set_sqlite_pragma(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute("PRAGMA synchronous=NORMAL")
+            cursor.close()
+
+
+@app.cli.command("init-db")
+def init_db():
+    """Create any missing database tables.
+
+    Run this once per deployment rather than from every instance, since
+    instances starting together would race on CREATE TABLE.
+    """
+    db.create_all()
@@ -1,5 +1,5 @@
-import os
-from hub import app
+from PIL import Image
+from hub import gcode_store
 from flask_wtf import FlaskForm
 from flask_wtf.file import FileField, FileAllowed
 from flask_login import current_user
@@ -55,6 +55,9 @@ class LoginForm(FlaskForm):
     submit = SubmitField("Login")
 
 
+max_picture_size = 4 * 1024 * 1024  # Largest profile picture upload in bytes
+
+
 class UpdateAccountForm(FlaskForm):
     username = StringField(
         "Username", validators=[DataRequired(), Length(min=4, max=20)]
@@ -65,6 +68,23 @@ class UpdateAccountForm(FlaskForm):
     )
     submit = SubmitField("Update")
 
+    def validate_picture(self, picture):
+        if picture.data:
+            picture.data.stream.seek(0, 2)
+            too_large = picture.data.stream.tell() > max_picture_size
+            picture.data.stream.seek(0)
+            if too_large:
+                raise ValidationError("Pictures can be at most 4 MB.")
+            try:
+                i = Image.open(picture.data.stream)
+                i.verify()
+            except Exception:
+                raise ValidationError("That file is not a valid image.")
+            finally:
+                picture.data.stream.seek(0)
+            if i.format not in ["JPEG", "PNG"]:
+                raise ValidationError("Upload a JPG or PNG image.")
+
     def validate_username(self, username):
         if username.data != current_user.username:
             user = User.query.filter_by(username=username.data).first()
@@ -84,12 +104,11 @@ class UpdateAccountForm(FlaskForm):
 
 colorChoices = ["Black", "Red", "Green", "Blue"]
 materialChoices = ["PLA", "ABS", "PETG"]
+ignore_filename_message = "A file with this name is already in the queue. Do you wish to replace the existing file? This will also replace the file for jobs that have previously been queued."
 
 
 def uploaded_files():
-    gcode_path = os.path.join(app.root_path, "static/gcode_files")
-    used_files = os.listdir(gcode_path)
-    return used_files
+    return gcode_store.list()
 
 
 class JobForm(FlaskForm):
@@ -118,7 +137,6 @@ class JobForm(FlaskForm):
             raise ValidationError("Choose a file to upload.")
         elif jobfile.data.filename in uploaded_files():
             if not self.ignore_filename.data:
-                ignore_filename_message = "A file with this name is already in the queue. Do you wish to replace the existing file? This will also replace the file for jobs that have previously been queued."
                 raise ValidationError(ignore_filename_message)
 
 
@@ -72,3 +72,14 @@ class Worker(db.Model):
         return "Worker({}, {}, {}, {})".format(
             self.id, self.name, self.filamentColor, self.filamentMaterial
         )
+
+
+class Lease(db.Model):
+    name = db.Column(db.String, primary_key=True)  # Name of the guarded task
+    holder = db.Column(db.String, nullable=False)  # INSTANCE_ID of the holder
+    expires = db.Column(
+        db.DateTime(timezone=True), nullable=False
+    )  # Lease is free after this time (UTC)
+
+    def __repr__(self):
+        return "Lease({}, {}, {})".format(self.name, self.holder, self.expires)
@@ -1,7 +1,13 @@
+import io
 import os
+import re
+import hashlib
 import secrets
-from datetime import datetime
-from PIL import Image
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from PIL import Image, ImageOps
 from flask import (
     render_template,
     url_for,
@@ -11,35 +17,59 @@ from flask import (
     abort,
     send_from_directory,
 )
-from hub import app, db, bcrypt
+from hub import app, db, bcrypt, gcode_store
 from hub.forms import (
     RegistrationForm,
     LoginForm,
     UpdateAccountForm,
     JobForm,
     WorkerForm,
+    ignore_filename_message,
 )
-from hub.models import User, Job, Worker
+from hub.models import User, Job, Worker, Lease
 from flask_login import login_user, current_user, logout_user, login_required
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
 
 
 @app.route("/")
 @app.route("/jobs/queue")
 def home():
-    jobs = Job.query.filter_by(status="Queue").order_by(Job.queuePosition)
-    return render_template("home.html", jobs=jobs, title="Queue")
+    jobs = (
+        Job.query.options(joinedload(Job.user))
+        .filter_by(status="Queue")
+        .order_by(Job.queuePosition, Job.id)
+        .all()
+    )
+    return render_template(
+        "home.html", jobs=jobs, avatars=job_avatars(jobs), title="Queue"
+    )
 
 
 @app.route("/jobs/current")
 def jobs_current():
-    jobs = Job.query.filter_by(status="Printing").order_by(Job.datePrintStart.desc())
-    return render_template("home.html", jobs=jobs, title="Current Jobs")
+    jobs = (
+        Job.query.options(joinedload(Job.user))
+        .filter_by(status="Printing")
+        .order_by(Job.datePrintStart.desc())
+        .all()
+    )
+    return render_template(
+        "home.html", jobs=jobs, avatars=job_avatars(jobs), title="Current Jobs"
+    )
 
 
 @app.route("/jobs/completed")
 def jobs_completed():
-    jobs = Job.query.filter_by(status="Completed").order_by(Job.datePrintFinish.desc())
-    return render_template("home.html", jobs=jobs, title="Completed Jobs")
+    jobs = (
+        Job.query.options(joinedload(Job.user))
+        .filter_by(status="Completed")
+        .order_by(Job.datePrintFinish.desc())
+        .all()
+    )
+    return render_template(
+        "home.html", jobs=jobs, avatars=job_avatars(jobs), title="Completed Jobs"
+    )
 
 
 @app.route("/about")
@@ -89,20 +119,151 @@ def logout():
     return redirect(url_for("home"))
 
 
-def save_picture(form_picture):
-    random_hex = secrets.token_hex(8)
-    _, f_ext = os.path.splitext(form_picture.filename)
-    picture_fn = random_hex + f_ext
-    picture_path = os.path.join(app.root_path, "static/profile_pics", picture_fn)
+# Avatars are resized off the request path into one WebP file per size. The
+# variants are named after the content hash of the upload, so their URLs can
+# be cached forever by the browser.
+AVATAR_SIZES = (65, 130, 250)
+AVATAR_MAX_AGE = 60 * 60 * 24 * 365
+PICTURE_EXTENSIONS = {"JPEG": ".jpg", "PNG": ".png"}
+# Uploads have always been given random or content-hash hex names, so a file
+# with such a name never changes.
+HEX_NAME = re.compile(r"^[0-9a-f]+(_\d+)?\.\w+$")
+avatar_executor = ThreadPoolExecutor(max_workers=2)
+avatar_lock = threading.Lock()
+avatar_variants = set()
+avatar_queued = set()
+default_avatar_file = None
+
+
+def avatar_dir():
+    return app.config["AVATAR_DIR"]
+
+
+def avatar_variant(image_file, size):
+    stem, _ = os.path.splitext(image_file)
+    return f"{stem}_{size}.webp"
+
+
+def temp_path(path):
+    return f"{path}.{uuid.uuid4().hex}.tmp"
+
+
+def resize_avatar(image_file):
+    picture_path = os.path.join(avatar_dir(), image_file)
+    largest = max(AVATAR_SIZES)
+    with Image.open(picture_path) as i:
+        picture_format = i.format
+        i = ImageOps.exif_transpose(i)
+        rgba = i.convert("RGBA")
+        for size in AVATAR_SIZES:
+            variant_path = os.path.join(avatar_dir(), avatar_variant(image_file, size))
+            tmp_path = temp_path(variant_path)
+            ImageOps.fit(rgba, (size, size), Image.LANCZOS).save(
+                tmp_path, "WEBP", quality=80, method=6
+            )
+            os.replace(tmp_path, variant_path)
+
+        # The upload is stored as received. Only the variants are ever shown,
+        # so shrink it here to keep the avatar directory small.
+        if max(i.size) > largest:
+            i.thumbnail((largest, largest))
+            tmp_path = temp_path(picture_path)
+            i.save(tmp_path, picture_format)
+            os.replace(tmp_path, picture_path)
+
+
+def resize_done(image_file, future):
+    if future.exception() is not None:
+        # Leave it marked as queued so a broken picture is not retried on
+        # every page view.
+        app.logger.error(
+            "Could not resize avatar %s", image_file, exc_info=future.exception()
+        )
+    else:
+        with avatar_lock:
+            avatar_queued.discard(image_file)
+
+
+def queue_resize(image_file):
+    with avatar_lock:
+        if image_file in avatar_queued:
+            return
+        avatar_queued.add(image_file)
+    future = avatar_executor.submit(resize_avatar, image_file)
+    future.add_done_callback(lambda f: resize_done(image_file, f))
+
+
+def store_picture(data):
+    # Only the header is parsed here; decoding and resizing happen in
+    # resize_avatar on the executor.
+    i = Image.open(io.BytesIO(data))
+    picture_fn = hashlib.sha256(data).hexdigest()[:12] + PICTURE_EXTENSIONS[i.format]
+    picture_path = os.path.join(avatar_dir(), picture_fn)
+
+    if not os.path.exists(picture_path):
+        os.makedirs(avatar_dir(), exist_ok=True)
+        tmp_path = temp_path(picture_path)
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, picture_path)
+    return picture_fn
 
-    output_size = (125, 125)
-    i = Image.open(form_picture)
-    i.thumbnail(output_size)
 
-    i.save(picture_path)
+def save_picture(form_picture):
+    picture_fn = store_picture(form_picture.read())
+    queue_resize(picture_fn)
     return picture_fn
 
 
+def default_avatar():
+    # default.jpg ships with the app. Store a copy under its content hash, so
+    # it is cached like any upload.
+    global default_avatar_file
+    if default_avatar_file is None:
+        default_path = os.path.join(app.root_path, "static/profile_pics/default.jpg")
+        with open(default_path, "rb") as f:
+            default_avatar_file = store_picture(f.read())
+    return default_avatar_file
+
+
+@app.template_global()
+def avatar_url(image_file, size):
+    if image_file == "default.jpg":
+        image_file = default_avatar()
+    variant = avatar_variant(image_file, size)
+    if variant not in avatar_variants:
+        if not os.path.exists(os.path.join(avatar_dir(), variant)):
+            # Show the default picture until the variants are written. This
+            # also backfills pictures uploaded before variants existed.
+            queue_resize(image_file)
+            if image_file != default_avatar():
+                return avatar_url(default_avatar(), size)
+            return url_for("avatar", filename=image_file)
+        avatar_variants.add(variant)
+    return url_for("avatar", filename=variant)
+
+
+def job_avatars(jobs):
+    # Resolve each user's avatar once per page instead of once per job row.
+    avatars = {}
+    for job in jobs:
+        if job.userID not in avatars:
+            avatars[job.userID] = (
+                avatar_url(job.user.image_file, 65),
+                avatar_url(job.user.image_file, 130),
+            )
+    return avatars
+
+
+@app.route("/avatar/<filename>")
+def avatar(filename):
+    if not HEX_NAME.match(filename):
+        return send_from_directory(avatar_dir(), filename)
+    response = send_from_directory(avatar_dir(), filename, max_age=AVATAR_MAX_AGE)
+    response.cache_control.immutable = True
+    return response
+
+
 @app.route("/account", methods=["GET", "POST"])
 @login_required
 def account():
@@ -119,32 +280,68 @@ def account():
     elif request.method == "GET":
         form.username.data = current_user.username
         form.email.data = current_user.email
-    image_file = url_for("static", filename="profile_pics/" + current_user.image_file)
+    image_file = avatar_url(current_user.image_file, 250)
     return render_template(
         "account.html", title="Account", image_file=image_file, form=form
     )
 
 
-def save_gcode(form_gcode):
+def save_gcode(form_gcode, overwrite=False):
     gcode_fn = form_gcode.filename
-    gcode_path = os.path.join(app.root_path, "static", "gcode_files", gcode_fn)
-    form_gcode.save(gcode_path)
+    gcode_store.save(form_gcode, gcode_fn, overwrite=overwrite)
     return gcode_fn
 
 
-def remove_old_gcode():
+# Files younger than this are kept even if no job refers to them yet, since
+# another instance may be between saving the upload and committing its job.
+GCODE_GRACE_PERIOD = 60
+# Cleanup runs at most once per lease period across all instances.
+CLEANUP_LEASE_SECONDS = 60
 
-    gcode_path = os.path.join(app.root_path, "static/gcode_files")
 
-    good_files = [
-        r.code
-        for r in Job.query.filter(Job.status.in_(["Queue", "Printing"])).distinct()
-    ]
-    all_files = os.listdir(gcode_path)
+def acquire_lease(name, seconds):
+    # Take the named lease if no unexpired one exists, including our own, so
+    # the lease also limits how often the guarded task runs. The conditional
+    # UPDATE makes sure only one instance can win it. Times are in UTC so
+    # instances in different timezones agree on expiry.
+    now = datetime.now(timezone.utc)
+    if Lease.query.filter(Lease.name == name, Lease.expires >= now).first():
+        return False  # Checked with a read first, to skip a write transaction
 
-    for file in all_files:
-        if file not in good_files:
-            os.remove(os.path.join(gcode_path, file))
+    holder = app.config["INSTANCE_ID"]
+    expires = now + timedelta(seconds=seconds)
+    claimed = Lease.query.filter(Lease.name == name, Lease.expires < now).update(
+        {Lease.holder: holder, Lease.expires: expires}, synchronize_session=False
+    )
+    if claimed:
+        db.session.commit()
+        return True
+    if Lease.query.get(name) is not None:
+        db.session.rollback()
+        return False
+    try:
+        db.session.add(Lease(name=name, holder=holder, expires=expires))
+        db.session.commit()
+        return True
+    except IntegrityError:
+        db.session.rollback()
+        return False
+
+
+def remove_old_gcode():
+    if not acquire_lease("remove_old_gcode", CLEANUP_LEASE_SECONDS):
+        return  # Cleaned up recently, by this or another instance
+
+    good_files = {
+        code
+        for (code,) in db.session.query(Job.code)
+        .filter(Job.status.in_(["Queue", "Printing"]))
+        .distinct()
+    }
+
+    for file in gcode_store.list():
+        if file not in good_files and gcode_store.age(file) > GCODE_GRACE_PERIOD:
+            gcode_store.delete(file)
 
 
 @app.route("/job/new", methods=["GET", "POST"])
@@ -153,23 +350,33 @@ def new_job():
     random_hex = secrets.token_hex(100)
     form = JobForm()
     if form.validate_on_submit():
-        job = Job(
-            title=form.title.data,
-            comment=form.comment.data,
-            code=save_gcode(form.jobfile.data),
-            color=form.color.data,
-            material=form.material.data,
-            qty=form.qty.data,
-            status="Queue",
-            user=current_user,
-            uploadID=random_hex,
-            queuePosition=int(len(Job.query.filter_by(status="Queue").all())) + 1,
-        )
-
-        db.session.add(job)
-        db.session.commit()
-        flash("Job has been added to the queue.", "success")
-        return redirect(url_for("new_job"))
+        try:
+            gcode_fn = save_gcode(form.jobfile.data, form.ignore_filename.data)
+        except FileExistsError:
+            # Another upload took the filename after the form checked it
+            form.jobfile.errors.append(ignore_filename_message)
+        else:
+            job = Job(
+                title=form.title.data,
+                comment=form.comment.data,
+                code=gcode_fn,
+                color=form.color.data,
+                material=form.material.data,
+                qty=form.qty.data,
+                status="Queue",
+                user=current_user,
+                uploadID=random_hex,
+                # Computed inside the INSERT so concurrent uploads get distinct
+                # positions
+                queuePosition=db.select(
+                    db.func.coalesce(db.func.max(Job.queuePosition), 0) + 1
+                ).scalar_subquery(),
+            )
+
+            db.session.add(job)
+            db.session.commit()
+            flash("Job has been added to the queue.", "success")
+            return redirect(url_for("new_job"))
     return render_template(
         "create_job.html", title="Create Job", form=form, legend="Create Job"
     )
@@ -178,7 +385,19 @@ def new_job():
 @app.route("/job/<int:job_id>")
 def job(job_id):
     job = Job.query.get_or_404(job_id)
-    return render_template("job.html", title="Edit " + job.title, job=job)
+    position = (
+        Job.query.filter(
+            Job.status == "Queue",
+            db.or_(
+                Job.queuePosition < job.queuePosition,
+                db.and_(Job.queuePosition == job.queuePosition, Job.id < job.id),
+            ),
+        ).count()
+        + 1
+    )
+    return render_template(
+        "job.html", title="Edit " + job.title, job=job, position=position
+    )
 
 
 @app.route("/job/<int:job_id>/edit", methods=["GET", "POST"])
@@ -215,9 +434,6 @@ def delete_job(job_id):
     job = Job.query.get_or_404(job_id)
     if job.user != current_user:
         abort(403)
-    qp = job.queuePosition
-    for j in Job.query.filter(Job.queuePosition > qp).all():
-        j.queuePosition = j.queuePosition - 1
     db.session.delete(job)
     db.session.commit()
     remove_old_gcode()
@@ -297,17 +513,38 @@ def getjob(worker_id):
         color = worker.filamentColor
         material = worker.filamentMaterial
 
-        # Select first job that fulfills printer requirements
-        job = (
-            Job.query.filter_by(color=color, material=material, status="Queue")
-            .order_by(Job.queuePosition)
-            .first()
-        )
-        if job != None:
+        # Select first job that fulfills printer requirements. Other instances
+        # may dispatch the same job concurrently, so each claim is a conditional
+        # UPDATE and we move on to the next candidate if it matched no row.
+        while True:
+            job = (
+                Job.query.filter_by(color=color, material=material, status="Queue")
+                .order_by(Job.queuePosition, Job.id)
+                .first()
+            )
+            if job == None:
+                break
 
             if job.qty > 1:
-                job.qty = job.qty - 1
+                claimed = Job.query.filter_by(
+                    id=job.id, status="Queue", qty=job.qty
+                ).update({Job.qty: Job.qty - 1}, synchronize_session=False)
+            else:
+                claimed = Job.query.filter_by(id=job.id, status="Queue", qty=1).update(
+                    {
+                        Job.status: "Printing",
+                        Job.datePrintStart: datetime.now(),
+                        Job.printerID: worker_id,
+                    },
+                    synchronize_session=False,
+                )
+            if claimed:
+                break
+            db.session.rollback()
+
+        if job != None:
 
+            if job.qty > 1:
                 # Duplicate the job but with 'Printing' status
                 printing_job = Job(
                     title=job.title,
@@ -324,22 +561,12 @@ def getjob(worker_id):
                     printerID=worker_id,
                 )
                 db.session.add(printing_job)
-                worker.status = "Printing"
-                db.session.commit()
-
-            elif job.qty == 1:
-                qp = job.queuePosition
-                for j in Job.query.filter(Job.queuePosition > qp).all():
-                    j.queuePosition = j.queuePosition - 1
-                job.status = "Printing"
-                job.datePrintStart = datetime.now()
-                job.printerID = worker_id
-                worker.status = "Printing"
-                db.session.commit()
-
-            filepath = os.path.join(app.root_path, "static/gcode_files")
-
-            return send_from_directory(filepath, job.code, as_attachment=True)
+
+            code = job.code
+            worker.status = "Printing"
+            db.session.commit()
+
+            return gcode_store.send(code)
         else:
             return "<h1>No Jobs For This Printer.</h1>"
     else:
@@ -349,16 +576,12 @@ def getjob(worker_id):
 @app.route("/printer/completejob/<int:worker_id>")
 def complete_job(worker_id):
     worker = Worker.query.get(worker_id)
-    job = Job.query.filter_by(status="Printing", printerID=worker_id).first()
-
-    if job != None:
+    completed = Job.query.filter_by(status="Printing", printerID=worker_id).update(
+        {Job.status: "Completed", Job.datePrintFinish: datetime.now()},
+        synchronize_session=False,
+    )
 
-        while job != None:
-            job.status = "Completed"
-            job.datePrintFinish = datetime.now()
-            worker.status = "Available"
-            db.session.commit()
-            job = Job.query.filter_by(status="Printing", printerID=worker_id).first()
+    if completed:
 
         worker.status = "Available"
         db.session.commit()
@@ -369,27 +592,39 @@ def complete_job(worker_id):
     return "<h1> No jobs being printed </h1>"
 
 
+def swap_queue_positions(job1, job2):
+    # Only swap if neither job has moved since we read the queue, otherwise
+    # another instance reordered it in the meantime and we leave it alone.
+    qp1 = job1.queuePosition
+    qp2 = job2.queuePosition
+    swapped = Job.query.filter(
+        db.or_(
+            db.and_(Job.id == job1.id, Job.queuePosition == qp1),
+            db.and_(Job.id == job2.id, Job.queuePosition == qp2),
+        )
+    ).update(
+        {Job.queuePosition: db.case((Job.id == job1.id, qp2), else_=qp1)},
+        synchronize_session=False,
+    )
+    if swapped == 2:
+        db.session.commit()
+    else:
+        db.session.rollback()
+
+
 @app.route("/queue_up/<int:job_id>")
 def queue_up(job_id):
 
-    jobs = Job.query.filter_by(status="Queue").order_by(Job.queuePosition).all()
+    jobs = (
+        Job.query.filter_by(status="Queue")
+        .order_by(Job.queuePosition, Job.id)
+        .all()
+    )
 
     job1_index = jobs.index(Job.query.get_or_404(job_id))
     job2_index = job1_index - 1
 
-    job1_id = jobs[job1_index].id
-    job2_id = jobs[job2_index].id
-
-    job1 = Job.query.get(job1_id)
-    job2 = Job.query.get(job2_id)
-
-    qp1 = job1.queuePosition
-    qp2 = job2.queuePosition
-
-    job1.queuePosition = qp2
-    job2.queuePosition = qp1
-
-    db.session.commit()
+    swap_queue_positions(jobs[job1_index], jobs[job2_index])
 
     return redirect(url_for("home"))
 
@@ -397,24 +632,16 @@ def queue_up(job_id):
 @app.route("/queue_down/<int:job_id>")
 def queue_down(job_id):
 
-    jobs = Job.query.filter_by(status="Queue").order_by(Job.queuePosition).all()
+    jobs = (
+        Job.query.filter_by(status="Queue")
+        .order_by(Job.queuePosition, Job.id)
+        .all()
+    )
 
     job1_index = jobs.index(Job.query.get_or_404(job_id))
     job2_index = job1_index + 1
 
-    job1_id = jobs[job1_index].id
-    job2_id = jobs[job2_index].id
-
-    job1 = Job.query.get(job1_id)
-    job2 = Job.query.get(job2_id)
-
-    qp1 = job1.queuePosition
-    qp2 = job2.queuePosition
-
-    job1.queuePosition = qp2
-    job2.queuePosition = qp1
-
-    db.session.commit()
+    swap_queue_positions(jobs[job1_index], jobs[job2_index])
 
     return redirect(url_for("home"))
 
@@ -422,16 +649,18 @@ def queue_down(job_id):
 @app.route("/queue_top/<int:job_id>")
 def queue_top(job_id):
 
-    jobs = Job.query.filter_by(status="Queue").order_by(Job.queuePosition).all()
-
-    job1_index = jobs.index(Job.query.get_or_404(job_id))
-
-    qp0 = jobs[0].queuePosition
-
-    for i in range(job1_index):
-        jobs[i].queuePosition = jobs[i].queuePosition + 1
-
-    Job.query.get_or_404(job_id).queuePosition = qp0
+    Job.query.get_or_404(job_id)
+
+    # Positions only need to be ordered, not contiguous, so moving a job to the
+    # top is a single UPDATE rather than renumbering the whole queue.
+    Job.query.filter_by(id=job_id).update(
+        {
+            Job.queuePosition: db.select(db.func.min(Job.queuePosition) - 1)
+            .where(Job.status == "Queue")
+            .scalar_subquery()
+        },
+        synchronize_session=False,
+    )
 
     db.session.commit()
 
@@ -441,16 +670,16 @@ def queue_top(job_id):
 @app.route("/queue_bottom/<int:job_id>")
 def queue_bottom(job_id):
 
-    jobs = Job.query.filter_by(status="Queue").order_by(Job.queuePosition).all()
+    Job.query.get_or_404(job_id)
 
-    job1_index = jobs.index(Job.query.get_or_404(job_id))
-
-    qp0 = jobs[len(jobs) - 1].queuePosition
-
-    for i in range(job1_index, len(jobs)):
-        jobs[i].queuePosition = jobs[i].queuePosition - 1
-
-    Job.query.get_or_404(job_id).queuePosition = qp0
+    Job.query.filter_by(id=job_id).update(
+        {
+            Job.queuePosition: db.select(db.func.max(Job.queuePosition) + 1)
+            .where(Job.status == "Queue")
+            .scalar_subquery()
+        },
+        synchronize_session=False,
+    )
 
     db.session.commit()
 
@@ -0,0 +1,66 @@
+import os
+import time
+import uuid
+from flask import send_from_directory
+
+
+class LocalFileStore:
+    """File store backed by a directory.
+
+    Several hub instances can share one store by pointing it at the same
+    directory, e.g. a network mount.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def save(self, file, filename, overwrite=False):
+        """Save ``file`` as ``filename``.
+
+        Raises FileExistsError if the name is taken, unless ``overwrite`` is
+        set. The check and the write are one step, so two instances can never
+        both claim the same name.
+        """
+        # Write to a temporary name first so other instances never see a
+        # partially written file.
+        path = os.path.join(self.root, filename)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        file.save(tmp_path)
+        if overwrite:
+            os.replace(tmp_path, path)
+            return
+        try:
+            try:
+                os.link(tmp_path, path)
+            except FileExistsError:
+                raise
+            except OSError:
+                # Many network filesystems have no hard links. Claim the name
+                # with an exclusive create instead; it is empty until the
+                # rename below fills it in.
+                os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def list(self):
+        return [f for f in os.listdir(self.root) if not f.endswith(".tmp")]
+
+    def age(self, filename):
+        return time.time() - os.path.getmtime(os.path.join(self.root, filename))
+
+    def delete(self, filename):
+        try:
+            os.remove(os.path.join(self.root, filename))
+        except FileNotFoundError:
+            pass  # Already removed by another instance
+
+    def send(self, filename):
+        return send_from_directory(self.root, filename, as_attachment=True)
+
+
+# Backends selectable with MANEVO_GCODE_BACKEND. Another store only needs the
+# methods of LocalFileStore and an entry here.
+BACKENDS = {"local": LocalFileStore}
@@ -1,5 +1,9 @@
-from hub import app
+from hub import app, db
 
 if __name__ == "__main__":
+    # A single development instance can create its own tables. Shared
+    # deployments run `flask --app hub init-db` once instead.
+    with app.app_context():
+        db.create_all()
     app.debug = False
     app.run(host="0.0.0.0")
@@ -0,0 +1,26 @@
+import os
+import sys
+import tempfile
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# hub reads its configuration on import, so point it at scratch stores first.
+TMP = tempfile.mkdtemp(prefix="manevo-tests-")
+os.environ["MANEVO_DATABASE_URI"] = "sqlite:///" + os.path.join(TMP, "hub.db")
+os.environ["MANEVO_GCODE_STORE"] = os.path.join(TMP, "gcode")
+os.environ["MANEVO_AVATAR_DIR"] = os.path.join(TMP, "avatars")
+
+from hub import app, db
+
+
+@pytest.fixture
+def client():
+    app.config["TESTING"] = True
+    app.config["WTF_CSRF_ENABLED"] = False
+    with app.app_context():
+        db.create_all()
+        yield app.test_client()
+        db.session.remove()
+        db.drop_all()
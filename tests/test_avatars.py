@@ -0,0 +1,109 @@
+import io
+import re
+import time
+import pytest
+from PIL import Image
+from hub import app, db
+from hub.forms import UpdateAccountForm, max_picture_size
+from hub.models import User, Job
+from hub.routes import avatar_url, default_avatar, resize_avatar, store_picture
+from wtforms.validators import ValidationError
+
+
+def picture_bytes(color, image_format="PNG", size=(800, 600)):
+    data = io.BytesIO()
+    Image.new("RGB", size, color).save(data, image_format)
+    return data.getvalue()
+
+
+def test_variant_is_served_immutable(client):
+    picture_fn = store_picture(picture_bytes("red"))
+    resize_avatar(picture_fn)
+
+    response = client.get("/avatar/" + picture_fn.replace(".png", "_65.webp"))
+
+    assert response.status_code == 200
+    assert response.mimetype == "image/webp"
+    assert response.cache_control.max_age == 60 * 60 * 24 * 365
+    assert response.cache_control.immutable
+    assert not response.cache_control.no_cache
+
+
+def test_original_is_downscaled_off_the_request_path(client):
+    data = picture_bytes("blue", "JPEG")
+    picture_fn = store_picture(data)
+    picture_path = app.config["AVATAR_DIR"] + "/" + picture_fn
+
+    assert picture_fn.endswith(".jpg")
+    with open(picture_path, "rb") as f:
+        assert f.read() == data
+
+    resize_avatar(picture_fn)
+    with Image.open(picture_path) as i:
+        assert max(i.size) == 250
+
+
+def test_default_is_shown_until_variants_exist(client):
+    picture_fn = store_picture(picture_bytes("green"))
+    resize_avatar(default_avatar())
+
+    with app.test_request_context():
+        assert avatar_url(picture_fn, 65) == avatar_url("default.jpg", 65)
+
+
+def test_non_image_upload_is_rejected(client):
+    data = {"picture": (io.BytesIO(b"<html><script>alert(1)</script>"), "x.jpg")}
+    with app.test_request_context("/account", method="POST", data=data):
+        form = UpdateAccountForm()
+        with pytest.raises(ValidationError):
+            form.validate_picture(form.picture)
+
+
+def test_oversized_upload_is_rejected(client):
+    data = {"picture": (io.BytesIO(b"\0" * (max_picture_size + 1)), "x.png")}
+    with app.test_request_context("/account", method="POST", data=data):
+        form = UpdateAccountForm()
+        with pytest.raises(ValidationError, match="4 MB"):
+            form.validate_picture(form.picture)
+
+
+def test_queue_page_weight(client):
+    # 1,000 queued jobs from 20 users, half of whom still use the default
+    # picture. Every row should share its user's single cached WebP avatar.
+    users = []
+    for n in range(20):
+        user = User(username=f"user{n}", email=f"user{n}@example.com", password="x")
+        if n % 2:
+            user.image_file = store_picture(picture_bytes((n * 10, 0, 0)))
+            resize_avatar(user.image_file)
+        users.append(user)
+    resize_avatar(default_avatar())
+    db.session.add_all(users)
+    for n in range(1000):
+        db.session.add(
+            Job(
+                title=f"job{n}",
+                code=f"job{n}.gcode",
+                color="Red",
+                material="PLA",
+                qty=1,
+                status="Queue",
+                user=users[n % len(users)],
+                queuePosition=n + 1,
+            )
+        )
+    db.session.commit()
+
+    start = time.time()
+    response = client.get("/")
+    elapsed = time.time() - start
+    images = set(re.findall(r'<img[^>]* src="([^"]+)"', response.text))
+    image_bytes = sum(len(client.get(url).data) for url in images)
+
+    print(
+        f"\n1,000-job queue: {len(response.data)} bytes HTML in {elapsed:.2f}s, "
+        f"{len(images)} image requests, {image_bytes} bytes of images"
+    )
+    assert response.status_code == 200
+    assert len(images) == 11
+    assert all(url.endswith("_65.webp") for url in images)
@@ -0,0 +1,43 @@
+import io
+import os
+import pytest
+from hub.storage import LocalFileStore
+from werkzeug.datastructures import FileStorage
+
+
+def upload(data):
+    return FileStorage(io.BytesIO(data))
+
+
+def test_save_does_not_replace_existing_file(tmp_path):
+    store = LocalFileStore(str(tmp_path))
+    store.save(upload(b"first"), "part.gcode")
+
+    with pytest.raises(FileExistsError):
+        store.save(upload(b"second"), "part.gcode")
+
+    assert (tmp_path / "part.gcode").read_bytes() == b"first"
+    assert store.list() == ["part.gcode"]
+
+
+def test_save_overwrite_replaces_file(tmp_path):
+    store = LocalFileStore(str(tmp_path))
+    store.save(upload(b"first"), "part.gcode")
+    store.save(upload(b"second"), "part.gcode", overwrite=True)
+
+    assert (tmp_path / "part.gcode").read_bytes() == b"second"
+
+
+def test_save_without_hard_links(tmp_path, monkeypatch):
+    def no_link(src, dst):
+        raise PermissionError("hard links not supported")
+
+    monkeypatch.setattr(os, "link", no_link)
+    store = LocalFileStore(str(tmp_path))
+    store.save(upload(b"first"), "part.gcode")
+
+    with pytest.raises(FileExistsError):
+        store.save(upload(b"second"), "part.gcode")
+
+    assert (tmp_path / "part.gcode").read_bytes() == b"first"
+    assert store.list() == ["part.gcode"]